@@ -1,24 +1,103 @@
+import asyncio
+import inspect
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
 from werkzeug.debug import DebuggedApplication
 
 from .configuration import config
-from .datastructures import AppStack
+from .datastructures import AppStack, LRUCache
 from .request import Request
 from .router import Router
-from .helpers import get_module_dir, make_static_file_router
+from .helpers import get_module_dir, make_static_file_router, asgi_scope_to_environ
+from .templates import precompile_templates
 from .exceptions import HTTPError
-from .errors import NotFound, InternalServerError
+from .errors import NotFound, MethodNotAllow, InternalServerError
 
 
 app_stack=AppStack()
 
 
+class _RouterList(list):
+
+    '''App.routers，增删router时通知App重新合并路由表。'''
+
+    def __init__(self, app, routers=()):
+        super().__init__(routers)
+        self._app=app
+    
+    def _changed(self):
+        self._app._invalidate()
+    
+    def append(self, router):
+        super().append(router)
+        self._changed()
+    
+    def extend(self, routers):
+        super().extend(routers)
+        self._changed()
+    
+    def insert(self, index, router):
+        super().insert(index, router)
+        self._changed()
+    
+    def remove(self, router):
+        super().remove(router)
+        self._changed()
+    
+    def pop(self, index=-1):
+        router=super().pop(index)
+        self._changed()
+        return router
+    
+    def clear(self):
+        super().clear()
+        self._changed()
+    
+    def __setitem__(self, index, value):
+        super().__setitem__(index, value)
+        self._changed()
+    
+    def __delitem__(self, index):
+        super().__delitem__(index)
+        self._changed()
+    
+    def sort(self, *args, **kwargs):
+        super().sort(*args, **kwargs)
+        self._changed()
+    
+    def reverse(self):
+        super().reverse()
+        self._changed()
+    
+    def __iadd__(self, routers):
+        self.extend(routers)
+        return self
+
+
 class App:
     
     '''WSGI Application Callable'''
     
     def __init__(self, app_module_name, *routers):
-        self.routers=list(routers)
+        #修改routers后下次请求时重新合并路由表
+        self.routers=_RouterList(self, routers)
+        #router -> prefix，没有记录的router挂在''下，同一个router只有一个prefix。
+        self.prefixes={}
         self.error_handler=None
+        #所有router合并后的路由表，第一次请求时(或finalize时)生成。
+        self._router=None
+        #(method, path) -> (view_func, args)，ROUTE_CACHE_SIZE为0时不缓存。
+        self.route_cache=None
+        #(middleware, args, kwargs)，先添加的在里层。
+        self.middlewares=[]
+        #包装好middleware的WSGI callable，只生成一次。
+        self._wsgi_stack=None
+        #ASGI下运行同步view function的线程池
+        self._executor=None
+        #{模板名: 编译用时(秒)}，warm_up后才有。
+        self.template_compile_times=None
         
         _app_dir=get_module_dir(app_module_name)
         config['APP_DIR']=_app_dir      
@@ -27,38 +106,132 @@ class App:
             _static_file_router=make_static_file_router()
             self.routers.append(_static_file_router)
         
+        #模板有语法错误时创建App就失败，不等到第一个请求。
+        if config['PRECOMPILE_TEMPLATES']:
+            self.warm_up()
+        
         app_stack.push(self)
     
-    def add_routers(self, *routers):
+    @property
+    def mounts(self):
+        '''[(prefix, router)]'''
+        return [(self.prefixes.get(router, ''), router) for router in self.routers]
+    
+    def add_routers(self, *routers, prefix=''):
+        for router in routers:
+            if prefix:
+                self.prefixes[router]=prefix
         self.routers.extend(routers)
     
+    def _invalidate(self, router=None):
+        #路由表改变了，下次请求时重新合并。
+        self._router=None
+        if self.route_cache is not None:
+            self.route_cache.clear()
+    
     def add_error_handler(self, handler):
         self.error_handler=handler
     
+    def add_middleware(self, middleware, *args, **kwargs):
+        '''middleware(app, *args, **kwargs)返回新的WSGI callable。'''
+        self.middlewares.append((middleware, args, kwargs))
+        self._wsgi_stack=None
+    
+    def finalize(self):
+        '''把所有router合并成一个路由表，挂在prefix下的router的路由都加上prefix。'''
+        router=Router()
+        for prefix, _router in self.mounts:
+            #直接加到routers里的router也要在修改路由时通知App
+            if self._invalidate not in _router.listeners:
+                _router.listeners.append(self._invalidate)
+            router.combine(_router, prefix=prefix)
+        #warm_up失败时不设置_router，之后的请求也会再次失败。
+        if config['PRECOMPILE_TEMPLATES'] and self.template_compile_times is None:
+            self.warm_up()
+        if config['ROUTE_CACHE_SIZE'] and self.route_cache is None:
+            self.route_cache=LRUCache(config['ROUTE_CACHE_SIZE'])
+        if self._wsgi_stack is None:
+            self._build_wsgi_stack()
+        self._router=router
+        return router
+    
+    def warm_up(self):
+        '''预先编译TEMPLATE_FILE_DIR下的所有模板，模板有语法错误时直接抛出异常。'''
+        try:
+            template_file_dir=config['TEMPLATE_FILE_DIR']
+        except KeyError:
+            config['TEMPLATE_FILE_DIR']='templates'
+            template_file_dir=config['TEMPLATE_FILE_DIR']
+        
+        self.template_compile_times=precompile_templates(template_file_dir)
+        return self.template_compile_times
+    
+    def _build_wsgi_stack(self):
+        app=self._wsgiapp
+        for middleware, args, kwargs in self.middlewares:
+            app=middleware(app, *args, **kwargs)
+        if config['DEBUG']:
+            app=DebuggedApplication(app=app)
+        self._wsgi_stack=app
+        return app
+    
+    def url_for(self, view_func_name, **query):
+        router=self._router or self.finalize()
+        return router.url_for(view_func_name, **query)
+    
+    def url_for_many(self, view_func_name, queries):
+        router=self._router or self.finalize()
+        return router.url_for_many(view_func_name, queries)
+    
     def get_view_func(self, method, path):
-        for router in self.routers:
-            result=router.match(method, path)
+        router=self._router or self.finalize()
+        route_cache=self.route_cache
+        if route_cache is not None:
+            result=route_cache.get((method, path))
             if result:
                 return result
+        
+        result=router.resolve(method, path)
+        if result:
+            view_func, args, cache=result
+            if cache and route_cache is not None:
+                route_cache.set((method, path), (view_func, args))
+            return view_func, args
+        allowed_methods=router.allowed_methods(path)
+        if allowed_methods:
+            raise MethodNotAllow(allowed_methods)
         raise NotFound
     
+    def _handle_error(self, request, error):
+        if self.error_handler:
+            response=self.error_handler.handle_error(request, error)
+        else:
+            response=error.create_response()
+        return response
+    
+    def _handle_internal_error(self, request):
+        internal_server_error=InternalServerError()
+        if self.error_handler:
+            try:
+                response=self.error_handler.handle_error(
+                    request, internal_server_error)
+            except Exception:
+                #如果自定义处理500的handler也出错，就用默认500页面。
+                response=InternalServerError().create_response()
+        else:
+            response=internal_server_error.create_response()
+        return response
+    
     def _handle_request(self, request):
         try:
             view_func, args=self.get_view_func(request.method, request.path)
-        except NotFound as e:
-            if self.error_handler:
-                response=self.error_handler.handle_error(request, e)
-            else:
-                response=e.create_response()
-            return response
+        except HTTPError as e:
+            return self._handle_error(request, e)
         
         try:
             response=view_func(request=request, **args)
         except HTTPError as e:
-            if self.error_handler:
-                response=self.error_handler.handle_error(request, e)
-            else:
-                response=e.create_response()
+            response=self._handle_error(request, e)
         
         return response
     
@@ -74,19 +247,111 @@ class App:
             if config['DEBUG']:
                 raise
             else:
-                internal_server_error=InternalServerError()
-                if self.error_handler:
-                    try:
-                        response=self.error_handler.handle_error(
-                            request, internal_server_error)
-                    except Exception:
-                        #如果自定义处理500的handler也出错，就用默认500页面。
-                        response=InternalServerError().create_response()
-                else:
-                    response=internal_server_error.create_response()  
+                response=self._handle_internal_error(request)
                 start_response(response.status, response.headerlist)
                 return response.get_body()                
+    
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor=ThreadPoolExecutor(
+                max_workers=config['ASGI_THREAD_POOL_SIZE'])
+        return self._executor
+    
+    async def _handle_request_async(self, request):
+        try:
+            view_func, args=self.get_view_func(request.method, request.path)
+        except HTTPError as e:
+            return self._handle_error(request, e)
+        
+        try:
+            if inspect.iscoroutinefunction(view_func):
+                response=await view_func(request=request, **args)
+            else:
+                #同步的view function放到线程池里，不阻塞event loop。
+                loop=asyncio.get_running_loop()
+                response=await loop.run_in_executor(
+                    self._get_executor(), partial(view_func, request=request, **args))
+                #被同步decorator包装的async view function返回的是coroutine
+                if inspect.isawaitable(response):
+                    response=await response
+        except HTTPError as e:
+            response=self._handle_error(request, e)
+        
+        return response
+    
+    async def _asgi_lifespan(self, receive, send):
+        while True:
+            message=await receive()
+            if message['type']=='lifespan.startup':
+                try:
+                    self.finalize()
+                except Exception as e:
+                    #通知server启动失败，不再接受请求。
+                    await send({'type': 'lifespan.startup.failed', 'message': repr(e)})
+                    return
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type']=='lifespan.shutdown':
+                if self._executor is not None:
+                    self._executor.shutdown(wait=False)
+                    self._executor=None
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+    
+    def _render_response(self, response):
+        #先取body，headerlist里的Content-Length要用到渲染结果。
+        body=response.get_body()
+        return response.headerlist, body
+    
+    async def asgi(self, scope, receive, send):
+        '''ASGI Application Callable，只支持http和lifespan。'''
+        if scope['type']=='lifespan':
+            await self._asgi_lifespan(receive, send)
+            return
+        if scope['type']!='http':
+            raise ValueError('Unsupported ASGI scope type %s.' %scope['type'])
+        
+        body=b''
+        while True:
+            message=await receive()
+            body+=message.get('body', b'')
+            if not message.get('more_body', False):
+                break
+        
+        request=Request(asgi_scope_to_environ(scope, body))
+        loop=asyncio.get_running_loop()
+        try:
+            response=await self._handle_request_async(request)
+            #模板在线程池里渲染，不阻塞event loop。
+            headerlist, body=await loop.run_in_executor(
+                self._get_executor(), self._render_response, response)
+        except Exception:
+            if config['DEBUG']:
+                raise
+            response=self._handle_internal_error(request)
+            headerlist, body=self._render_response(response)
+        
+        await send({
+            'type': 'http.response.start',
+            'status': response.code,
+            'headers': [(key.encode('latin1'), str(value).encode('latin1')) 
+                        for key, value in headerlist]
+        })
+        if response.is_streaming:
+            #流式body的迭代可能阻塞，放到线程池里取每一块。
+            chunks=iter(body)
+            try:
+                while True:
+                    chunk=await loop.run_in_executor(self._get_executor(), next, chunks, None)
+                    if chunk is None:
+                        break
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            finally:
+                body.close()
+        else:
+            for chunk in body:
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
                         
     def __call__(self, environ, start_response):
-        app=DebuggedApplication(app=self._wsgiapp)
+        app=self._wsgi_stack or self._build_wsgi_stack()
         return app(environ, start_response)
\ No newline at end of file
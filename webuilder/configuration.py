@@ -12,4 +12,34 @@ config['SERVE_STATIC_FILE']=True
 config['DEV_SERVER']='wsgiref_server'
 config['APP_DIR']=os.path.join(os.getcwd(), '')
 config['TEMPLATE_ENGINE']='jinja2'
-config['SESSION_STORE']='filesystem'
\ No newline at end of file
+config['SESSION_STORE']='filesystem'
+config['ROUTE_CACHE_SIZE']=0
+config['ASGI_THREAD_POOL_SIZE']=10
+config['TEMPLATE_AUTO_RELOAD']=True
+config['TEMPLATE_STREAM_CHUNK_SIZE']=4096
+config['PRECOMPILE_TEMPLATES']=False
+config['PRECOMPILE_TEMPLATE_EXTENSIONS']=['.html', '.htm', '.xml', '.txt', '.jinja', '.jinja2', '.j2', '.mako']
+config['TEMPLATE_FRAGMENT_CACHE_SIZE']=1024
+config['TEMPLATE_FRAGMENT_CACHE_TTL']=300
+config['RESPONSE_CACHE_SIZE']=1024
+config['DATABASE_POOL_SIZE']=5
+config['DATABASE_POOL_TIMEOUT']=30
+config['DATABASE_WAL']=False
+config['DATABASE_PRAGMAS']={}
+config['DATABASE_STATEMENT_CACHE_SIZE']=128
+config['DATABASE_QUERY_CACHE']=False
+config['DATABASE_QUERY_CACHE_SIZE']=256
+config['DATABASE_QUERY_CACHE_BYTES']=16*1024*1024
+config['SESSION_COOKIE_COMPRESS_THRESHOLD']=256
+config['SESSION_COOKIE_MAX_SIZE']=4000
+config['SESSION_LIFETIME']=14*24*3600
+config['SESSION_SHARDS']=1
+config['SESSION_PURGE_INTERVAL']=1000
+config['SESSION_PURGE_BATCH_SIZE']=500
+config['SESSION_MEMORY_MAX_ENTRIES']=10000
+config['SESSION_MEMORY_MAX_BYTES']=64*1024*1024
+config['SESSION_WRITE_BEHIND']=False
+config['SESSION_FLUSH_INTERVAL']=5
+config['SESSION_GC_INTERVAL']=None
+config['SESSION_GC_MAX_FILES']=1000
+config['STATIC_FILE_BLOCK_SIZE']=64*1024
\ No newline at end of file
@@ -0,0 +1,495 @@
+import re
+import sys
+import asyncio
+import time
+import queue
+import sqlite3
+import threading
+
+from collections import OrderedDict
+
+from .configuration import config
+
+
+_READ_PATTERN=re.compile(r'^\s*select\b', re.IGNORECASE)
+
+#表名，可以带schema前缀(main.entries)和引号
+_TABLE_NAME=(r'[\'"`\[]?(?:[A-Za-z_][A-Za-z0-9_]*[\'"`\]]?\.[\'"`\[]?)?'
+             r'([A-Za-z_][A-Za-z0-9_]*)[\'"`\]]?')
+
+#from后面用逗号分隔的表，每个表可以有别名
+_FROM_ITEM=_TABLE_NAME+r'(?:\s+(?:as\s+)?[A-Za-z_][A-Za-z0-9_]*)?'
+_FROM_LIST_PATTERN=re.compile(
+    r'\bfrom\s+(%s(?:\s*,\s*%s)*)' %(_FROM_ITEM, _FROM_ITEM), re.IGNORECASE)
+_JOIN_PATTERN=re.compile(r'\bjoin\s+'+_TABLE_NAME, re.IGNORECASE)
+_TABLE_NAME_PATTERN=re.compile(r'^\s*'+_TABLE_NAME)
+
+#写操作修改的表
+_WRITE_TABLE_PATTERN=re.compile(
+    r'^\s*(?:'
+    r'(?:insert|replace)\s+(?:or\s+\w+\s+)?into'
+    r'|update\s+(?:or\s+\w+\s+)?'
+    r'|delete\s+from'
+    r')\s*'+_TABLE_NAME, re.IGNORECASE)
+
+
+def _read_tables(sql):
+    '''select语句里用到的表(小写，不带schema)。'''
+    tables=set()
+    for from_list in _FROM_LIST_PATTERN.findall(sql):
+        for item in from_list[0].split(','):
+            match_result=_TABLE_NAME_PATTERN.match(item)
+            if match_result:
+                tables.add(match_result.group(1).lower())
+    for table in _JOIN_PATTERN.findall(sql):
+        tables.add(table.lower())
+    return tables
+
+
+def _freeze_parameters(parameters):
+    if isinstance(parameters, dict):
+        return tuple(sorted(parameters.items()))
+    return tuple(parameters)
+
+
+class QueryCache:
+
+    '''缓存只读查询的结果，有写操作时按表清除。
+       
+       以条数和估算的字节数为上限，超过时淘汰最久没用到的结果。
+       表名是从SQL里解析出来的，trigger或者view间接修改的表不会清除。
+       '''
+
+    def __init__(self, max_entries=256, max_bytes=16*1024*1024):
+        self.max_entries=max_entries
+        self.max_bytes=max_bytes
+        self.hits=0
+        self.misses=0
+        #(sql, parameters) -> (description, rows, size, tables)
+        self._data=OrderedDict()
+        #table -> {(sql, parameters)}
+        self._tables={}
+        self._bytes=0
+        #每次清除时加1，查询期间有清除的话结果不放进缓存。
+        self._epoch=0
+        #table -> 清除的次数
+        self._generations={}
+        self._lock=threading.Lock()
+
+    def _sizeof(self, rows):
+        size=sys.getsizeof(rows)
+        for row in rows:
+            size+=sys.getsizeof(row)+sum(sys.getsizeof(value) for value in row)
+        return size
+
+    def _remove(self, key):
+        _, _, size, tables=self._data.pop(key)
+        self._bytes-=size
+        for table in tables:
+            keys=self._tables.get(table)
+            if keys:
+                keys.discard(key)
+                if not keys:
+                    del self._tables[table]
+
+    def get(self, key):
+        with self._lock:
+            try:
+                description, rows, _, _=self._data[key]
+            except KeyError:
+                self.misses+=1
+                return None
+            self._data.move_to_end(key)
+            self.hits+=1
+            return description, rows
+
+    def _generation(self, tables):
+        return self._epoch, tuple(self._generations.get(table, 0) for table in sorted(tables))
+
+    def generation(self, tables):
+        '''执行查询之前调用，结果放进缓存时用来检查这些表有没有被清除过。'''
+        with self._lock:
+            return self._generation(tables)
+
+    def set(self, key, tables, description, rows, generation=None):
+        size=self._sizeof(rows)
+        if size>self.max_bytes:
+            return
+        with self._lock:
+            #查询期间别的连接修改了这些表，结果可能是旧的。
+            if generation is not None and generation!=self._generation(tables):
+                return
+            if key in self._data:
+                self._remove(key)
+            self._data[key]=(description, rows, size, tables)
+            self._bytes+=size
+            for table in tables:
+                self._tables.setdefault(table, set()).add(key)
+            while len(self._data)>self.max_entries or self._bytes>self.max_bytes:
+                self._remove(next(iter(self._data)))
+
+    def invalidate(self, tables=None):
+        '''清除用到tables的结果，tables为None时全部清除。'''
+        with self._lock:
+            if tables is None:
+                self._epoch+=1
+                self._data.clear()
+                self._tables.clear()
+                self._bytes=0
+                return
+            for table in tables:
+                self._generations[table]=self._generations.get(table, 0)+1
+                for key in list(self._tables.get(table, ())):
+                    self._remove(key)
+
+    def __len__(self):
+        return len(self._data)
+
+
+class CachedCursor:
+
+    '''缓存的查询结果，提供和sqlite3.Cursor一样的读取方法。'''
+
+    def __init__(self, description, rows):
+        self.description=description
+        self.rowcount=-1
+        self._rows=rows
+        self._pos=0
+
+    def fetchone(self):
+        if self._pos>=len(self._rows):
+            return None
+        row=self._rows[self._pos]
+        self._pos+=1
+        return row
+
+    def fetchmany(self, size=1):
+        rows=self._rows[self._pos:self._pos+size]
+        self._pos+=len(rows)
+        return rows
+
+    def fetchall(self):
+        rows=self._rows[self._pos:]
+        self._pos=len(self._rows)
+        return rows
+
+    def close(self):
+        pass
+
+    def __iter__(self):
+        while True:
+            row=self.fetchone()
+            if row is None:
+                return
+            yield row
+
+
+class _InvalidatingCursor:
+
+    '''LazyConnection.cursor()返回的cursor，查询不经过缓存，写操作后清除缓存。'''
+
+    def __init__(self, handle, cursor):
+        self._handle=handle
+        self._cursor=cursor
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def execute(self, sql, parameters=()):
+        self._cursor.execute(sql, parameters)
+        if not _READ_PATTERN.match(sql):
+            self._handle._invalidate(self._handle._written_tables(sql))
+        return self
+
+    def executemany(self, sql, seq_of_parameters):
+        self._cursor.executemany(sql, seq_of_parameters)
+        self._handle._invalidate(self._handle._written_tables(sql))
+        return self
+
+    def executescript(self, sql_script):
+        self._cursor.executescript(sql_script)
+        self._handle._invalidate(None)
+        return self
+
+
+class SQLitePool:
+
+    '''有上限的SQLite连接池，连接用完后放回池中复用。'''
+
+    def __init__(self, db_file, max_size=5, timeout=30, wal=False, 
+                 pragmas=None, cached_statements=128, query_cache=None):
+        self.db_file=db_file
+        self.max_size=max_size
+        self.timeout=timeout
+        self.wal=wal
+        self.pragmas=pragmas or {}
+        self.cached_statements=cached_statements
+        #QueryCache，为None时不缓存查询结果。
+        self.query_cache=query_cache
+        
+        self.checkouts=0
+        self.waits=0
+        self.created=0
+        self._size=0
+        #正在等待空闲连接的线程数
+        self._waiting=0
+        self._idle=queue.LifoQueue()
+        self._lock=threading.Lock()
+
+    def _connect(self):
+        #连接会在不同线程间传递，但同一时间只有一个线程使用。
+        conn=sqlite3.connect(self.db_file, check_same_thread=False,
+                             cached_statements=self.cached_statements)
+        if self.wal:
+            conn.execute('PRAGMA journal_mode=WAL')
+        for name, value in self.pragmas.items():
+            conn.execute('PRAGMA %s=%s' %(name, value))
+        return conn
+
+    def checkout(self):
+        with self._lock:
+            self.checkouts+=1
+        deadline=time.monotonic()+self.timeout
+        waited=False
+        while True:
+            try:
+                conn=self._idle.get_nowait()
+            except queue.Empty:
+                conn=None
+                with self._lock:
+                    create=self._size<self.max_size
+                    if create:
+                        self._size+=1
+                    else:
+                        if not waited:
+                            self.waits+=1
+                            waited=True
+                        self._waiting+=1
+                if create:
+                    try:
+                        conn=self._connect()
+                    except Exception:
+                        with self._lock:
+                            self._size-=1
+                        raise
+                    with self._lock:
+                        self.created+=1
+                    return conn
+                
+                try:
+                    conn=self._idle.get(timeout=max(deadline-time.monotonic(), 0))
+                except queue.Empty as e:
+                    raise RuntimeError('Timed out waiting for a connection to %s.' 
+                                       %self.db_file) from e
+                finally:
+                    with self._lock:
+                        self._waiting-=1
+            #None表示有连接被丢弃，空出了位置，重新尝试创建。
+            if conn is not None:
+                return conn
+
+    def checkin(self, conn):
+        try:
+            #没有commit的修改和原来关闭连接时一样丢弃。
+            if conn.in_transaction:
+                conn.rollback()
+            #view function改过的连接属性恢复成默认值
+            conn.row_factory=None
+            conn.text_factory=str
+            conn.isolation_level=''
+        except sqlite3.Error:
+            self.discard(conn)
+            return
+        self._idle.put(conn)
+
+    def discard(self, conn):
+        '''丢弃已经关闭或者出错的连接。'''
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+        with self._lock:
+            self._size-=1
+            waiting=self._waiting>0
+        if waiting:
+            self._idle.put(None)
+
+    @property
+    def stats(self):
+        return {
+            'checkouts': self.checkouts,
+            'waits': self.waits,
+            'created': self.created,
+            'size': self._size,
+            'idle': self._idle.qsize()
+        }
+
+
+class LazyConnection:
+
+    '''第一次使用时才从连接池取出连接，其余属性都转给sqlite3.Connection。'''
+
+    def __init__(self, pool):
+        self._pool=pool
+        self._conn=None
+        #还没commit的写操作修改的表，commit后要再清除一次缓存，
+        #因为commit之前别的连接可能又缓存了旧的结果。
+        self._written=[]
+
+    @property
+    def connection(self):
+        if self._conn is None:
+            self._conn=self._pool.checkout()
+        return self._conn
+
+    async def acquire(self):
+        '''在线程池里从连接池取连接，async view function用，不阻塞event loop。'''
+        if self._conn is None:
+            loop=asyncio.get_running_loop()
+            self._conn=await loop.run_in_executor(None, self._pool.checkout)
+        return self
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+    
+    def __setattr__(self, name, value):
+        #row_factory等属性设置到连接上，放回连接池时恢复默认值。
+        if name.startswith('_'):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self.connection, name, value)
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        #和sqlite3.Connection一样，没有异常时commit，否则rollback。
+        if self._conn is None:
+            return False
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+        return False
+
+    def _cacheable(self):
+        #事务里能读到自己还没commit的修改，这些结果不能给别的连接用；
+        #改过row_factory的连接返回的行也和别的连接不一样。
+        conn=self.connection
+        if conn.in_transaction or self._written:
+            return False
+        return conn.row_factory is None and conn.text_factory is str
+
+    def _written_tables(self, sql):
+        match_result=_WRITE_TABLE_PATTERN.match(sql)
+        #不知道修改了哪个表(比如DDL)，只能全部清除。
+        return [match_result.group(1).lower()] if match_result else None
+
+    def execute(self, sql, parameters=()):
+        query_cache=self._pool.query_cache
+        if query_cache is None:
+            return self.connection.execute(sql, parameters)
+        
+        if not _READ_PATTERN.match(sql):
+            cursor=self.connection.execute(sql, parameters)
+            self._invalidate(self._written_tables(sql))
+            return cursor
+        
+        if not self._cacheable():
+            return self.connection.execute(sql, parameters)
+        
+        try:
+            key=(sql, _freeze_parameters(parameters))
+            hash(key)
+        except TypeError:
+            return self.connection.execute(sql, parameters)
+        
+        cached=query_cache.get(key)
+        if cached is not None:
+            return CachedCursor(*cached)
+        
+        tables=_read_tables(sql)
+        if not tables:
+            #找不到用到的表，没法在写操作后清除，不缓存。
+            return self.connection.execute(sql, parameters)
+        
+        generation=query_cache.generation(tables)
+        cursor=self.connection.execute(sql, parameters)
+        description, rows=cursor.description, cursor.fetchall()
+        query_cache.set(key, tables, description, rows, generation)
+        return CachedCursor(description, rows)
+
+    def cursor(self, *args):
+        cursor=self.connection.cursor(*args)
+        if self._pool.query_cache is None:
+            return cursor
+        return _InvalidatingCursor(self, cursor)
+
+    def executemany(self, sql, seq_of_parameters):
+        cursor=self.connection.executemany(sql, seq_of_parameters)
+        self._invalidate(self._written_tables(sql))
+        return cursor
+
+    def executescript(self, sql_script):
+        cursor=self.connection.executescript(sql_script)
+        self._invalidate(None)
+        return cursor
+
+    def _invalidate(self, tables):
+        if self._pool.query_cache is not None:
+            self._pool.query_cache.invalidate(tables)
+            self._written.append(tables)
+
+    def commit(self):
+        self.connection.commit()
+        self._invalidate_written()
+
+    def _invalidate_written(self):
+        for tables in self._written:
+            self._pool.query_cache.invalidate(tables)
+        self._written=[]
+
+    def rollback(self):
+        self.connection.rollback()
+        self._invalidate_written()
+
+    def close(self):
+        #连接不真正关闭，放回连接池。
+        self.release()
+
+    def release(self):
+        if self._conn is not None:
+            conn, self._conn=self._conn, None
+            self._pool.checkin(conn)
+        #没有commit的修改已经回滚
+        self._invalidate_written()
+
+
+#db_file -> SQLitePool
+_pools={}
+_pools_lock=threading.Lock()
+
+
+def get_pool(db_file):
+    try:
+        return _pools[db_file]
+    except KeyError:
+        pass
+    
+    with _pools_lock:
+        if db_file not in _pools:
+            _pools[db_file]=SQLitePool(
+                db_file,
+                max_size=config['DATABASE_POOL_SIZE'],
+                timeout=config['DATABASE_POOL_TIMEOUT'],
+                wal=config['DATABASE_WAL'],
+                pragmas=config['DATABASE_PRAGMAS'],
+                cached_statements=config['DATABASE_STATEMENT_CACHE_SIZE'],
+                query_cache=QueryCache(
+                    config['DATABASE_QUERY_CACHE_SIZE'], 
+                    config['DATABASE_QUERY_CACHE_BYTES']
+                ) if config['DATABASE_QUERY_CACHE'] else None)
+        return _pools[db_file]
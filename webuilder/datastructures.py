@@ -1,5 +1,8 @@
 import os
+import threading
+import time
 
+from collections import OrderedDict
 from collections.abc import MutableMapping
 from importlib.machinery import SourceFileLoader
 from importlib import import_module
@@ -40,6 +43,97 @@ class AppStack:
         return self._stack.__str__()
 
 
+class LRUCache:
+
+    '''线程安全的LRU缓存，超过max_size条或max_bytes字节时淘汰最久没用到的项。
+       
+       set时可以指定ttl(秒)，过期的项get时当作不存在；
+       size是这一项占用的字节数，设置了max_bytes时才需要。
+       '''
+
+    def __init__(self, max_size=128, ttl=None, max_bytes=None):
+        self.max_size=max_size
+        self.ttl=ttl
+        self.max_bytes=max_bytes
+        self.hits=0
+        self.misses=0
+        #key -> (value, 过期时间, size)，过期时间为None表示不过期。
+        self._data=OrderedDict()
+        self._bytes=0
+        self._lock=threading.Lock()
+
+    def _remove(self, key):
+        _, _, size=self._data.pop(key)
+        self._bytes-=size
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expires, _=self._data[key]
+            except KeyError:
+                self.misses+=1
+                return default
+            if expires is not None and expires<=time.monotonic():
+                self._remove(key)
+                self.misses+=1
+                return default
+            self._data.move_to_end(key)
+            self.hits+=1
+            return value
+
+    def set(self, key, value, ttl=None, size=0):
+        ttl=ttl if ttl is not None else self.ttl
+        expires=time.monotonic()+ttl if ttl is not None else None
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            self._data[key]=(value, expires, size)
+            self._bytes+=size
+            while len(self._data)>self.max_size or \
+                  (self.max_bytes is not None and self._bytes>self.max_bytes):
+                self._remove(next(iter(self._data)))
+
+    def touch(self, key, ttl=None):
+        '''重新计算key的过期时间，key不存在或已过期时返回False。'''
+        ttl=ttl if ttl is not None else self.ttl
+        now=time.monotonic()
+        with self._lock:
+            try:
+                value, expires, size=self._data[key]
+            except KeyError:
+                return False
+            if expires is not None and expires<=now:
+                self._remove(key)
+                return False
+            self._data[key]=(value, now+ttl if ttl is not None else None, size)
+            self._data.move_to_end(key)
+            return True
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes=0
+
+    def keys(self):
+        with self._lock:
+            return list(self._data)
+
+    @property
+    def bytes(self):
+        return self._bytes
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+
 class EasyAccessMixin:
 
     def __getattr__(self, key):
@@ -81,10 +175,15 @@ class CookieDict(EasyAccessDict):
 
 class SessionDict(dict):
 
-    '''session字典。'''
+    '''session字典，记录是否被修改过，没修改过就不用保存。
+    
+       修改嵌套的可变对象(比如session['cart'].append(item))时检测不到，
+       需要调用mark_modified()。
+       '''
 
     def __init__(self, sid=None):
         self._sid=sid
+        self.modified=False
         dict.__init__(self)
     
     def _get_sid(self):
@@ -94,6 +193,41 @@ class SessionDict(dict):
         self._sid=str(sid)
         
     sid=property(_get_sid, _set_sid)
+    
+    def mark_modified(self):
+        self.modified=True
+    
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self.modified=True
+    
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self.modified=True
+    
+    def pop(self, key, *default):
+        if key in self:
+            self.modified=True
+        return dict.pop(self, key, *default)
+    
+    def popitem(self):
+        item=dict.popitem(self)
+        self.modified=True
+        return item
+    
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self.modified=True
+        return dict.setdefault(self, key, default)
+    
+    def update(self, *args, **kwargs):
+        dict.update(self, *args, **kwargs)
+        self.modified=True
+    
+    def clear(self):
+        if self:
+            self.modified=True
+        dict.clear(self)
 
 
 class BaseMultiDict(MutableMapping):
@@ -356,6 +490,8 @@ class ConfigDict(CaseInsensitiveDict):
     _file_dir=[
         'STATIC_FILE_DIR',
         'TEMPLATE_FILE_DIR',
+        'TEMPLATE_BYTECODE_CACHE_DIR',
+        'TEMPLATE_MODULE_DIR',
         'DATABASE_FILE',
         'SESSION_DIR'
     ]
@@ -65,6 +65,11 @@ class MethodNotAllow(HTTPError):
     _default_status='405 Method Not Allow'
     _default_body=_DEFAULT_ERROR_BODY %(405, 'Method Not Allow')
 
+    def __init__(self, allowed_methods=None, template_file=None, body=None, **template_args):
+        HTTPError.__init__(self, template_file=template_file, body=body, **template_args)
+        if allowed_methods:
+            self.header['Allow']=', '.join(allowed_methods)
+
 
 class InternalServerError(HTTPError):
     
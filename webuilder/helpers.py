@@ -3,6 +3,7 @@ import os
 import mimetypes
 
 from importlib import import_module
+from io import BytesIO
 
 import arrow
     
@@ -74,6 +75,45 @@ def environ_value_to_unicode(environ_value, encoding='utf-8'):
         return environ_value.encode('latin1').decode(encoding)        
     
 
+def asgi_scope_to_environ(scope, body=b''):
+    '''把ASGI的http scope转换成WSGI environ，这样就能直接用Request。'''
+    server=scope.get('server') or ('localhost', 80)
+    environ={
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/%s' %scope.get('http_version', '1.1'),
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR']=scope['client'][0]
+    
+    for name, value in scope.get('headers', []):
+        name, value=name.decode('latin1'), value.decode('latin1')
+        if name=='content-type':
+            environ['CONTENT_TYPE']=value
+        elif name=='content-length':
+            continue
+        else:
+            key='HTTP_'+name.upper().replace('-', '_')
+            if key in environ:
+                #HTTP/2下cookie会分成多个header，要用'; '连接。
+                separator='; ' if key=='HTTP_COOKIE' else ','
+                value=environ[key]+separator+value
+            environ[key]=value
+    return environ
+
+
 def make_static_file_router():
     from .configuration import config
     from .router import Router
@@ -119,8 +159,11 @@ def make_static_file_router():
             response.header['Content-Encoding']=encoding
         response.header['Last-Modified']=last_modified_str
     
-        with open(file_path, 'rb') as f:
-            response.body=f.read()
+        #文件交给wsgi.file_wrapper(server可能用sendfile)或者分块读取，
+        #由server在发送完后关闭。
+        response.set_file(open(file_path, 'rb'), 
+                          request.environ.get('wsgi.file_wrapper'),
+                          config['STATIC_FILE_BLOCK_SIZE'])
         return response
     
     return router
\ No newline at end of file
@@ -1,5 +1,5 @@
+import os
 import datetime
-import itertools
 
 import arrow
 
@@ -14,6 +14,66 @@ from .templates import get_template_cls
 _HTTP_STATUS_CODE=responses.copy()
 
 
+class StreamingBody:
+
+    '''流式body，迭代时才逐块编码，WSGI server结束时会调用close()。
+       
+       charset可以是返回编码的函数，开始迭代时才确定编码。
+       min_chunk_size大于0时，小块会先合并到至少这么大再输出，避免太多小的write。
+       '''
+
+    def __init__(self, iterable, charset='utf-8', min_chunk_size=0):
+        self._iterable=iterable
+        self.charset=charset
+        self.min_chunk_size=min_chunk_size
+
+    def __iter__(self):
+        charset=self.charset() if callable(self.charset) else self.charset
+        buffer=[]
+        buffer_size=0
+        for chunk in self._iterable:
+            if isinstance(chunk, str):
+                chunk=chunk.encode(charset)
+            elif not isinstance(chunk, bytes):
+                raise TypeError('Body iterable can only yield str/bytes, %s got.' 
+                                %type(chunk))
+            #空的chunk会被WSGI server当作结束，跳过。
+            if not chunk:
+                continue
+            buffer.append(chunk)
+            buffer_size+=len(chunk)
+            if buffer_size>=self.min_chunk_size:
+                yield b''.join(buffer)
+                buffer=[]
+                buffer_size=0
+        if buffer:
+            yield b''.join(buffer)
+
+    def close(self):
+        close=getattr(self._iterable, 'close', None)
+        if close is not None:
+            close()
+
+
+class FileIterator:
+
+    '''按固定大小分块读取文件，server没有提供wsgi.file_wrapper时用。'''
+
+    def __init__(self, file_obj, block_size=8192):
+        self._file=file_obj
+        self.block_size=block_size
+
+    def __iter__(self):
+        while True:
+            data=self._file.read(self.block_size)
+            if not data:
+                return
+            yield data
+
+    def close(self):
+        self._file.close()
+
+
 class BaseResponse:
 
     '''设置响应header, body等的类'''
@@ -23,14 +83,16 @@ class BaseResponse:
     _default_content_type="text/html;charset=UTF-8"
     _default_body=''
     
-    def __init__(self, template_file=None, body=None, **template_args):
+    def __init__(self, template_file=None, body=None, stream=False, **template_args):
         self._status=self._default_status
         self._header=ResponseHeader()
         self._cookies={}
+        #get_body()的结果，body或template改变时清空。
+        self._rendered=None
         
         if template_file:
             self._body=None
-            self.set_template(template_file, **template_args)
+            self.set_template(template_file, stream=stream, **template_args)
         elif body:
             self._template=None
             self.body=body
@@ -45,16 +107,16 @@ class BaseResponse:
             code=int(status)
         except (ValueError, TypeError):
             if ' ' in status:
-                code, status=status.strip().split(1)
+                code, status=status.strip().split(' ', 1)
                 if not int(code) in _HTTP_STATUS_CODE:
-                    raise ValueError('HTTP code must be between 100 to 511, %d got.' %code)
+                    raise ValueError('HTTP code must be between 100 to 511, %s got.' %code)
                 self._status='%s %s' %(code, status)
             else:
                 raise ValueError('Bad HTTP status format %s.' %status)            
         else:
             try:
                 status=_HTTP_STATUS_CODE[code]
-                self._status='%d %s' (code, status)
+                self._status='%d %s' %(code, status)
             except KeyError:
                 raise ValueError('HTTP Status Code must be between 100 to 511, %d got.' %code)
     
@@ -75,9 +137,8 @@ class BaseResponse:
         if not 'Content-Type' in self._header:
             if self.get_body():
                 headerlist.append(('Content-Type', self._default_content_type))
-        if not 'Content-Length' in self._header:
-            #如果body是generator，会报错。
-            #暂不清楚怎么处理body是generator的情形。
+        #流式body不设置Content-Length，由WSGI server决定怎么分块。
+        if not 'Content-Length' in self._header and not self.is_streaming:
             try:
                 content_length=len(self.get_body()[0])
             except IndexError:
@@ -166,6 +227,7 @@ class BaseResponse:
         #不能同时设置body和template。
         if self._template:
             raise TypeError('Can not set both body and template.')
+        self._rendered=None
         if not body:
             self._body=None
             return
@@ -180,31 +242,43 @@ class BaseResponse:
         if isinstance(body, bytes):
             self._body=body
             return
+        if isinstance(body, StreamingBody):
+            self._body=body
+            return
         
         try:
-            body=iter(body)
-            first_yield=next(body)
-            while not first_yield:
-                first_yield=next(body)
-        except StopIteration:
-            raise ValueError('Body can not be empty.')
-        except Exception:
-            raise
-        else:
-            if isinstance(first_yield, str):
-                body=map(lambda item:item.encode(self.charset),
-                         itertools.chain([first_yield], body))
-            elif isinstance(first_yield, bytes):
-                body=itertools.chain([first_yield], body)
-            else:
-                raise TypeError('Unsupported body type.' %type(first_yield))        
-            self._body=body
+            iter(body)
+        except TypeError as e:
+            raise TypeError('Unsupported body type %s.' %type(body)) from e
+        #不预先读取，迭代时才生成和编码每一块；传原来的对象，close()才能调用到它的close。
+        self._body=StreamingBody(body, self._charset_get)
     
     body=property(_get_body, _set_body)
     
-    def set_template(self, template_file, **template_args):
+    @property
+    def is_streaming(self):
+        #StreamingBody或者set_file设置的文件
+        return self._body is not None and not isinstance(self._body, bytes)
+    
+    def set_file(self, file_obj, file_wrapper=None, block_size=8192):
+        '''用打开的文件(二进制模式)作为body。
+        
+           file_wrapper是environ['wsgi.file_wrapper']，server支持时可以用sendfile
+           直接发送文件，不需要把内容读到内存里；没有时按block_size分块读取。
+           '''
+        if self._template:
+            raise TypeError('Can not set both body and template.')
+        self._rendered=None
+        self._header['Content-Length']=os.fstat(file_obj.fileno()).st_size
+        if file_wrapper is not None:
+            self._body=file_wrapper(file_obj, block_size)
+        else:
+            self._body=FileIterator(file_obj, block_size)
+    
+    def set_template(self, template_file, stream=False, **template_args):
         if self._body:
             raise TypeError('Can not set both body and template.')
+        self._rendered=None
         if not template_file:
             self._template=None
             return
@@ -224,17 +298,25 @@ class BaseResponse:
             
         self._template=template_engine(
             template_file_dir, template_file, **template_args)
+        if stream:
+            #边渲染边输出，不需要等整个页面渲染完。
+            self._body=StreamingBody(self._template.generate(), self._charset_get,
+                                     config['TEMPLATE_STREAM_CHUNK_SIZE'])
     
     @property
     def template(self):
         return self._template
     
     def get_body(self):
-        if self._template:
-            body=[self._template().encode('utf-8')]
-        else:
-            body=[self._body] if self._body else [self._default_body.encode(self.charset)]
-        return body
+        #模板只渲染一次，headerlist和WSGI返回值都用这个结果。
+        if self._rendered is None:
+            if self.is_streaming:
+                self._rendered=self._body
+            elif self._template:
+                self._rendered=[self._template().encode('utf-8')]
+            else:
+                self._rendered=[self._body] if self._body else [self._default_body.encode(self.charset)]
+        return self._rendered
     
     def copy(self):
         response=self.__class__()
@@ -242,10 +324,10 @@ class BaseResponse:
         response._header=self._header
         response._cookies=self._cookies
         
-        if self._template:
-            response._template=self._template
-        else:
-            response.body=self._body
+        #_body已经是处理过的bytes、StreamingBody或文件，直接复制，
+        #不能再经过body的setter，否则文件会被包装成StreamingBody。
+        response._template=self._template
+        response._body=self._body
         return response
     
     def __getitem__(self, key):
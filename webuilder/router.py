@@ -30,18 +30,54 @@ _PATH_PATTERN=re.compile(
 _DEFAULT_PATTERN=r'[^/]+'
 
 
+class Filter:
+
+    '''路由filter，包括编译好的pattern，以及url和python值之间的转换函数。'''
+
+    def __init__(self, pattern, to_python=str, to_url=str, in_segment=False):
+        self.pattern=pattern if isinstance(pattern, str) else str(pattern)
+        self.regex=re.compile(self.pattern)
+        self.to_python=to_python
+        self.to_url=to_url
+        #pattern不会匹配到'/'时为True，可以按路径段(segment)匹配。
+        self.in_segment=in_segment
+
+
 _SUPPORTED_FILTERS={
-    'int': r'\d+',
-    'float': r'\d+\.\d+',
-    'alpha': r'[A-Za-z]+',
-    'word': r'\w+',
-    'segment': r'[^/]+'
+    'int': Filter(r'\d+', int, str, in_segment=True),
+    'float': Filter(r'\d+\.\d+', float, str, in_segment=True),
+    'alpha': Filter(r'[A-Za-z]+', in_segment=True),
+    'word': Filter(r'\w+', in_segment=True),
+    'segment': Filter(r'[^/]+', in_segment=True)
 }
 
 
-def add_filter(self, filter_name, pattern):
-    pattern=pattern if isinstance(pattern, str) else str(pattern)
-    _SUPPORTED_FILTERS[filter_name]=pattern
+#没有指定filter或re时用的filter
+_DEFAULT_FILTER=Filter(_DEFAULT_PATTERN, in_segment=True)
+
+
+def add_filter(filter_name, pattern, to_python=str, to_url=str, in_segment=False):
+    if isinstance(pattern, Filter):
+        _SUPPORTED_FILTERS[filter_name]=pattern
+    else:
+        _SUPPORTED_FILTERS[filter_name]=Filter(pattern, to_python, to_url, in_segment)
+
+
+class _Node:
+
+    '''路由前缀树的节点，每一层对应路径中的一段。'''
+
+    __slots__=('static', 'dynamic', 'tails', 'endpoints')
+
+    def __init__(self):
+        #段的字符串 -> 子节点
+        self.static={}
+        #(pattern字符串, converters) -> (编译后的pattern, converters, 子节点)
+        self.dynamic={}
+        #(pattern字符串, converters) -> (编译后的pattern, converters, endpoints)，匹配剩余的整个路径
+        self.tails={}
+        #method -> (view_func, cache)
+        self.endpoints={}
 
 
 class Router:
@@ -49,11 +85,17 @@ class Router:
     '''路由类'''
 
     def __init__(self):
+        #静态路径 -> {method: view_func}
         self.static_mappings={}
-        self.dynamic_mappings={}      
+        #动态路径的前缀树
+        self.dynamic_mappings=_Node()
         self.builders={}
+        #(path, method, view_func, cache)，合并router时用。
+        self.rules=[]
+        #路由表改变时调用，App用来清空路由缓存。
+        self.listeners=[]
     
-    def add_mapping(self, path, methods, view_func=None):
+    def add_mapping(self, path, methods, view_func=None, cache=True):
         def decorator(view_func):
             if isinstance(view_func, str):
                 view_func=load_obj(view_func)
@@ -63,7 +105,9 @@ class Router:
                 method=method.upper()
                 if not method in _SUPPORTED_METHODS:
                     raise ValueError('Unsupported method %s.' %method)
-                self._process_mapping(path, method, view_func)
+                self._process_mapping(path, method, view_func, cache)
+            for listener in self.listeners:
+                listener(self)
             return view_func
         
         return decorator(view_func) if view_func else decorator
@@ -102,47 +146,107 @@ class Router:
         if pos<len(path):
             yield path[pos:], None, None, None    
             
-    def _process_mapping(self, path, method, view_func):
-        path_pattern=''
-        is_static=True
-        builder=[]
-        
+    def _parse_rule(self, path):
+        #返回[(static_part, name, filter)]，静态部分name和filter为None。
+        parts=[]
         for _static_part,  _dynamic_part, _filter_or_re , _pattern in self._parse_path(path):
-            _is_static=True
             if _static_part:
-                path_pattern+=re.escape(_static_part)
-                builder.append((_static_part, _is_static))
+                parts.append((_static_part, None, None))
             elif _dynamic_part:
-                is_static=_is_static=False
-                if _filter_or_re:
-                    if _filter_or_re=='filter':
-                        try:
-                            _pattern=_SUPPORTED_FILTERS[_pattern]
-                        except KeyError as e:
-                            raise ValueError('No such filter %s' %_pattern) from e
-                    elif _filter_or_re=='re':
-                        _pattern=_pattern
+                if _filter_or_re=='filter':
+                    try:
+                        _filter=_SUPPORTED_FILTERS[_pattern]
+                    except KeyError as e:
+                        raise ValueError('No such filter %s' %_pattern) from e
+                elif _filter_or_re=='re':
+                    #自定义的正则可能匹配到'/'，只能和剩余的路径一起匹配。
+                    _filter=Filter(_pattern)
                 else:
-                    _pattern=_DEFAULT_PATTERN
-                path_pattern+='(?P<%s>%s)' %(_dynamic_part, _pattern)
-                builder.append((_dynamic_part, _is_static))
+                    _filter=_DEFAULT_FILTER
+                parts.append((None, _dynamic_part, _filter))
+        return parts
 
-        self.builders[view_func.__name__]=builder
+    def _split_segments(self, parts):
+        #按'/'把parts切分成段。
+        segments=[[]]
+        for _static_part, _dynamic_part, _filter in parts:
+            if _static_part is not None:
+                pieces=_static_part.split('/')
+                if pieces[0]:
+                    segments[-1].append((pieces[0], None, None))
+                for piece in pieces[1:]:
+                    segments.append([(piece, None, None)] if piece else [])
+            else:
+                segments[-1].append((None, _dynamic_part, _filter))
+        return segments
 
-        if is_static:
-            self.static_mappings.setdefault(method, {})
-            self.static_mappings[method][path]=(view_func, None)
+    def _make_pattern(self, parts):
+        path_pattern=''
+        converters=[]
+        for _static_part, _dynamic_part, _filter in parts:
+            if _static_part is not None:
+                path_pattern+=re.escape(_static_part)
+            else:
+                path_pattern+='(?P<%s>%s)' %(_dynamic_part, _filter.pattern)
+                if _filter.to_python is not str:
+                    converters.append((_dynamic_part, _filter.to_python))
+        return path_pattern, tuple(converters)
+
+    def _process_mapping(self, path, method, view_func, cache=True, overwrite=True):
+        '''overwrite为False时，已经有同一路径和method的路由就不添加，返回是否添加了。'''
+        parts=self._parse_rule(path)
+        node=None
+        endpoints=None
+        if all(_static_part is not None for _static_part, *_ in parts):
+            endpoints=self.static_mappings.setdefault(path, {})
         else:
-            path_pattern=re.compile('^(%s)$' %path_pattern)
-            args=lambda url: path_pattern.match(url).groupdict()
-            self.dynamic_mappings.setdefault(method, {})
-            self.dynamic_mappings[method][path_pattern]=(view_func, args)        
-    
-    def get(self, path):
-        return self.add_mapping(path, methods='GET')
+            node=self.dynamic_mappings
+            segments=self._split_segments(parts)
+            for index, _parts in enumerate(segments):
+                if not all(_filter.in_segment for _, _, _filter in _parts if _filter):
+                    #剩余的段拼回去，整体作为一个pattern。
+                    rest=[]
+                    for __parts in segments[index:]:
+                        if rest:
+                            rest.append(('/', None, None))
+                        rest.extend(__parts)
+                    path_pattern, converters=self._make_pattern(rest)
+                    _, _, endpoints=node.tails.setdefault(
+                        (path_pattern, converters), (re.compile(path_pattern), converters, {}))
+                    break
+                if all(_static_part is not None for _static_part, *_ in _parts):
+                    segment=''.join(_static_part for _static_part, *_ in _parts)
+                    node=node.static.setdefault(segment, _Node())
+                else:
+                    path_pattern, converters=self._make_pattern(_parts)
+                    _, _, node=node.dynamic.setdefault(
+                        (path_pattern, converters), (re.compile(path_pattern), converters, _Node()))
+            else:
+                endpoints=node.endpoints
+        
+        #builder是(format模板, [(name, filter)])，生成url时只需format一次。
+        if overwrite or view_func.__name__ not in self.builders:
+            template=''
+            fields=[]
+            for _static_part, _dynamic_part, _filter in parts:
+                if _static_part is not None:
+                    template+=_static_part.replace('{', '{{').replace('}', '}}')
+                else:
+                    template+='{%s}' %_dynamic_part
+                    fields.append((_dynamic_part, _filter))
+            self.builders[view_func.__name__]=(template, tuple(fields))
+        
+        if not overwrite and method in endpoints:
+            return False
+        endpoints[method]=(view_func, cache)
+        self.rules.append((path, method, view_func, cache))
+        return True
 
-    def post(self, path):
-        return self.add_mapping(path, methods='POST')
+    def get(self, path, cache=True):
+        return self.add_mapping(path, methods='GET', cache=cache)
+
+    def post(self, path, cache=True):
+        return self.add_mapping(path, methods='POST', cache=cache)
     
     def put(self, path):
         raise NotImplementedError('Working on it...')
@@ -150,44 +254,113 @@ class Router:
     def delete(self, path):
         raise NotImplementedError('Working on it...')
     
-    def expose(self, path):
-        return self.add_mapping(path, methods=['GET', 'POST'])
+    def expose(self, path, cache=True):
+        return self.add_mapping(path, methods=['GET', 'POST'], cache=cache)
             
+    def _convert(self, match_result, converters, args):
+        #pattern匹配后转换成python值，转换失败当作没有匹配。
+        _args=dict(args)
+        _args.update(match_result.groupdict())
+        for name, to_python in converters:
+            try:
+                _args[name]=to_python(_args[name])
+            except (ValueError, TypeError):
+                return None
+        return _args
+
+    def _walk(self, node, segments, index, args):
+        #深度优先，静态段优先于动态段，动态段优先于剩余路径的pattern。
+        if index==len(segments):
+            if node.endpoints:
+                yield node.endpoints, args
+            return
+
+        segment=segments[index]
+        child=node.static.get(segment)
+        if child is not None:
+            yield from self._walk(child, segments, index+1, args)
+        for path_pattern, converters, child in node.dynamic.values():
+            match_result=path_pattern.fullmatch(segment)
+            if match_result:
+                _args=self._convert(match_result, converters, args)
+                if _args is not None:
+                    yield from self._walk(child, segments, index+1, _args)
+        if node.tails:
+            rest='/'.join(segments[index:])
+            for path_pattern, converters, endpoints in node.tails.values():
+                match_result=path_pattern.fullmatch(rest)
+                if match_result:
+                    _args=self._convert(match_result, converters, args)
+                    if _args is not None:
+                        yield endpoints, _args
+
+    def _iter_matches(self, url):
+        if url in self.static_mappings:
+            yield self.static_mappings[url], {}
+        yield from self._walk(self.dynamic_mappings, url.split('/'), 0, {})
+
+    def resolve(self, method, url):
+        '''返回(view_func, args, cache)，cache表示结果能否被缓存。'''
+        for endpoints, args in self._iter_matches(url):
+            if method in endpoints:
+                view_func, cache=endpoints[method]
+                return view_func, args, cache
+        return None
+
     def match(self, method, url):
-        if method in self.static_mappings:
-            if url in self.static_mappings[method]:
-                view_func, _=self.static_mappings[method][url]
-                return view_func, {}
-        elif method in self.dynamic_mappings:
-            for path_pattern in self.dynamic_mappings[method]:
-                if path_pattern.match(url):
-                    view_func, args=self.dynamic_mappings[method][path_pattern]
-                    return view_func, args(url)
+        result=self.resolve(method, url)
+        if result:
+            return result[:2]
         return None
+
+    def allowed_methods(self, url):
+        methods=set()
+        for endpoints, _ in self._iter_matches(url):
+            methods.update(endpoints)
+        return sorted(methods)
     
-    def url_for(self, view_func_name, **query):
-        try:
-            builder=self.builders[view_func_name]
-        except KeyError as e:
-            raise ValueError('No such mapping %s' %name) from e
-        else:
-            url=''
-            for url_parts, is_static in builder:
-                if is_static:
-                    url+=url_parts
-                else:
-                    try:
-                        url+=str(query.pop(url_parts))
-                    except KeyError as e:
-                        raise TypeError('Missing argument %s to build url.' %url_parts) from e
+    def _build_url(self, builder, query):
+        template, fields=builder
+        values={}
+        for name, _filter in fields:
+            try:
+                value=_filter.to_url(query.pop(name))
+            except KeyError as e:
+                raise TypeError('Missing argument %s to build url.' %name) from e
+            if not _filter.regex.fullmatch(value):
+                raise ValueError('Argument %s=%s does not match pattern %s.' 
+                                 %(name, value, _filter.pattern))
+            values[name]=value
+        url=template.format_map(values)
         
         #如果query还有剩余，作为查询部分(?后面)
         if query:
             url+='?'+urlencode(query)
         return url
     
-    def combine(self, *routers):
+    def _get_builder(self, view_func_name):
+        try:
+            return self.builders[view_func_name]
+        except KeyError as e:
+            raise ValueError('No such mapping %s' %view_func_name) from e
+    
+    def url_for(self, view_func_name, **query):
+        builder=self._get_builder(view_func_name)
+        return self._build_url(builder, query)
+    
+    def url_for_many(self, view_func_name, queries):
+        '''为同一个view function批量生成url，queries是参数字典的列表。'''
+        builder=self._get_builder(view_func_name)
+        return [self._build_url(builder, dict(query)) for query in queries]
+    
+    def combine(self, *routers, prefix=''):
+        '''合并routers的路由，同一路径和method先合并进来的router优先。'''
         for router in routers:
-            self.static_mappings.update(router.static_mappings)
-            self.dynamic_mappings.update(router.dynamic_mappings)
-            self.builders.update(router.builders)
\ No newline at end of file
+            #同一个router里后添加的路由覆盖先添加的
+            rules={}
+            for path, method, view_func, cache in router.rules:
+                rules[(prefix+path, method)]=(view_func, cache)
+            for (path, method), (view_func, cache) in rules.items():
+                self._process_mapping(path, method, view_func, cache, overwrite=False)
+        for listener in self.listeners:
+            listener(self)
\ No newline at end of file
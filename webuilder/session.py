@@ -1,8 +1,23 @@
 import os
+import hmac
+import atexit
+import json
+import time
+import zlib
+import base64
 import pickle
-import uuid
+import hashlib
+import sqlite3
+import struct
+import secrets
+import tempfile
+import threading
 
-from .datastructures import SessionDict
+from collections.abc import MutableMapping
+
+from .configuration import config
+from .datastructures import SessionDict, LRUCache
+from .helpers import make_list
 
 
 class BaseSession:
@@ -11,14 +26,15 @@ class BaseSession:
 
     def __init__(self, session_dir):
         self.session_dir=session_dir
+        #可以设置成worker或分片的标识，加在sid前面。
+        self.sid_prefix=config.get('SESSION_SID_PREFIX') or ''
     
     def _make_sid(self):
-        for i in range(100):
-            sid=str(uuid.uuid4())
-            try:
-                _=self._load_session(sid)
-            except Exception:
-                return sid
+        #256位随机数，不会重复，不需要检查是否已经存在。
+        sid=secrets.token_urlsafe(32)
+        if self.sid_prefix:
+            sid='%s.%s' %(self.sid_prefix, sid)
+        return sid
     
     def _load_session(self, sid):
         raise NotImplementedError
@@ -30,39 +46,510 @@ class BaseSession:
         sid=self._make_sid()
         return SessionDict(sid)        
     
+    def cookie_value(self, session):
+        '''SESSIONID cookie的值，服务器端存储的session就是sid。'''
+        return session.sid
+    
     def get_session(self, sid):
         try:
             session=self._load_session(sid)
-            return session
         except Exception:
-            return SessionDict(sid)
+            #过期或者不存在的sid不能再用，防止session fixation。
+            return self.create_new_session()
+        session.modified=False
+        return session
+
+
+class LazySession(MutableMapping):
+
+    '''session代理，第一次读写时才通过session_manager加载或新建session。'''
+
+    def __init__(self, session_manager, sid=None):
+        self._session_manager=session_manager
+        self._sid=sid
+        self._session=None
+
+    @property
+    def loaded(self):
+        return self._session is not None
+
+    @property
+    def session(self):
+        if self._session is None:
+            if self._sid:
+                self._session=self._session_manager.get_session(self._sid)
+            else:
+                self._session=self._session_manager.create_new_session()
+        return self._session
+
+    @property
+    def sid(self):
+        return self.session.sid
+
+    @property
+    def modified(self):
+        return self._session is not None and self._session.modified
+
+    def mark_modified(self):
+        self.session.mark_modified()
+
+    def __getitem__(self, key):
+        return self.session[key]
+
+    def __setitem__(self, key, value):
+        self.session[key]=value
+
+    def __delitem__(self, key):
+        del self.session[key]
+
+    def __iter__(self):
+        return iter(self.session)
+
+    def __len__(self):
+        return len(self.session)
+
+    def __str__(self):
+        return self.session.__str__() if self.loaded else '<LazySession not loaded>'
 
 
 class FileSystemSession(BaseSession):
 
-    '''基于文件系统存储的session'''
+    '''基于文件系统存储的session
+    
+       文件按sid的hash分到两层子目录(session_dir/ab/cd/sid)，
+       文件开头8个字节是过期时间，后面是pickle后的session。
+       SESSION_GC_INTERVAL不为None时，后台线程定期调用collect_garbage删除过期的文件。
+       '''
+
+    _header=struct.Struct('!d')
+    _shard_count=256*256
+
+    def __init__(self, session_dir):
+        BaseSession.__init__(self, session_dir)
+        self.lifetime=config['SESSION_LIFETIME']
+        #collect_garbage下次从第几个子目录开始
+        self._gc_cursor=0
+        self._gc_lock=threading.Lock()
+        if config.get('SESSION_GC_INTERVAL'):
+            self.start_gc_thread(config['SESSION_GC_INTERVAL'], 
+                                 config['SESSION_GC_MAX_FILES'])
+
+    def _get_path(self, sid):
+        sid=str(sid)
+        #sid来自cookie，不能让它跳出session_dir。
+        if not sid or os.sep in sid or (os.altsep and os.altsep in sid) or sid.startswith('.'):
+            raise KeyError(sid)
+        digest=hashlib.sha1(sid.encode('utf-8')).hexdigest()
+        return os.path.join(self.session_dir, digest[:2], digest[2:4], sid)
 
     def _load_session(self, sid):
-        file_path=os.path.join(self.session_dir, str(sid))
-        with open(file_path, 'rb') as f:
+        file_path=self._get_path(sid)
+        try:
+            f=open(file_path, 'rb')
+        except FileNotFoundError:
+            return self._migrate_legacy_session(sid)
+        
+        now=time.time()
+        with f:
+            expires,=self._header.unpack(f.read(self._header.size))
+            if expires<=now:
+                f.close()
+                self._remove(file_path)
+                raise KeyError(sid)
             session=pickle.load(f)
-            return session
+        
+        #只读的请求不保存session，剩余时间不到一半时只更新文件开头的过期时间。
+        if expires-now<self.lifetime/2:
+            try:
+                with open(file_path, 'r+b') as f:
+                    f.write(self._header.pack(now+self.lifetime))
+            except FileNotFoundError:
+                pass
+        return session
+
+    def _migrate_legacy_session(self, sid):
+        '''以前没有分目录、也没有过期时间的session文件，按修改时间算过期时间，
+           移到子目录里后删除原来的文件。
+           '''
+        legacy_path=os.path.join(self.session_dir, str(sid))
+        with open(legacy_path, 'rb') as f:
+            expires=os.fstat(f.fileno()).st_mtime+self.lifetime
+            session=pickle.load(f) if expires>time.time() else None
+        if session is not None:
+            self._write(session, expires)
+        self._remove(legacy_path)
+        if session is None:
+            raise KeyError(sid)
+        return session
+
+    def _write(self, session, expires):
+        #先写到临时文件再改名，其它请求不会读到写了一半的文件。
+        file_path=self._get_path(session.sid)
+        file_dir=os.path.dirname(file_path)
+        os.makedirs(file_dir, exist_ok=True)
+        fd, temp_path=tempfile.mkstemp(dir=file_dir, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(self._header.pack(expires))
+                pickle.dump(session, f)
+            os.replace(temp_path, file_path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
 
     def save_session(self, session):
-        file_path=os.path.join(self.session_dir, session.sid)
-        with open(file_path, 'wb') as f:
-            pickle.dump(session, f)
+        self._write(session, time.time()+self.lifetime)
+        session.modified=False
+
+    def _remove(self, file_path):
+        try:
+            os.unlink(file_path)
+        except FileNotFoundError:
+            pass
+
+    def collect_garbage(self, max_files=1000, max_dirs=256):
+        '''删除过期的session文件，返回删除的个数。
+        
+           每次最多检查max_dirs个子目录、约max_files个文件，
+           接着上次停下的子目录检查，多次调用就能扫完整个session_dir。
+           '''
+        now=time.time()
+        checked=removed=0
+        with self._gc_lock:
+            for _ in range(min(max_dirs, self._shard_count)):
+                if checked>=max_files:
+                    break
+                #每扫完一遍子目录，检查一次session_dir下以前没有分目录的文件。
+                if self._gc_cursor==0:
+                    _checked, _removed=self._collect_legacy_garbage(now)
+                    checked+=_checked
+                    removed+=_removed
+                digest='%04x' %self._gc_cursor
+                self._gc_cursor=(self._gc_cursor+1)%self._shard_count
+                shard_dir=os.path.join(self.session_dir, digest[:2], digest[2:])
+                try:
+                    file_names=os.listdir(shard_dir)
+                except FileNotFoundError:
+                    continue
+                
+                for file_name in file_names:
+                    file_path=os.path.join(shard_dir, file_name)
+                    checked+=1
+                    try:
+                        if file_name.startswith('.tmp-'):
+                            #写入中断留下的临时文件
+                            expired=os.path.getmtime(file_path)+3600<=now
+                        else:
+                            with open(file_path, 'rb') as f:
+                                expires,=self._header.unpack(f.read(self._header.size))
+                            expired=expires<=now
+                    except (OSError, struct.error):
+                        continue
+                    if expired:
+                        self._remove(file_path)
+                        removed+=1
+        return removed
+
+    def _collect_legacy_garbage(self, now):
+        checked=removed=0
+        try:
+            entries=list(os.scandir(self.session_dir))
+        except FileNotFoundError:
+            return checked, removed
+        
+        for entry in entries:
+            try:
+                if not entry.is_file(follow_symlinks=False):
+                    continue
+                checked+=1
+                lifetime=3600 if entry.name.startswith('.tmp-') else self.lifetime
+                expired=entry.stat(follow_symlinks=False).st_mtime+lifetime<=now
+            except OSError:
+                continue
+            if expired:
+                self._remove(entry.path)
+                removed+=1
+        return checked, removed
+
+    def start_gc_thread(self, interval=60, max_files=1000):
+        def gc_loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.collect_garbage(max_files)
+                except Exception:
+                    pass
+        
+        thread=threading.Thread(target=gc_loop, daemon=True)
+        thread.start()
+        return thread
 
 
 class CookiesSession(BaseSession):
-    pass
+
+    '''签名后存在cookie里的session，服务器端不需要任何存储。
+    
+       session的值用json序列化，只能保存json支持的类型。
+       SECRET_KEY可以是一个列表，用第一个签名，列表里的都可以验证，方便更换key。
+       '''
+
+    def __init__(self, session_dir=None):
+        BaseSession.__init__(self, session_dir)
+        try:
+            secret_keys=make_list(config['SECRET_KEY'])
+        except KeyError as e:
+            raise ValueError('SECRET_KEY must be set to use cookies session.') from e
+        self.secret_keys=[key.encode('utf-8') if isinstance(key, str) else key 
+                          for key in secret_keys]
+        self.compress_threshold=config['SESSION_COOKIE_COMPRESS_THRESHOLD']
+        self.max_size=config['SESSION_COOKIE_MAX_SIZE']
+        self.lifetime=config.get('SESSION_LIFETIME')
+
+    def _sign(self, payload, key):
+        signature=hmac.new(key, payload.encode('ascii'), hashlib.sha256).digest()
+        return base64.urlsafe_b64encode(signature).rstrip(b'=').decode('ascii')
+
+    def dumps(self, session):
+        data=json.dumps([session.sid, int(time.time()), session], 
+                        separators=(',', ':')).encode('utf-8')
+        #压缩过的payload以'.'开头
+        prefix=''
+        if len(data)>self.compress_threshold:
+            compressed=zlib.compress(data)
+            if len(compressed)<len(data):
+                data, prefix=compressed, '.'
+        payload=prefix+base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+        value='%s.%s' %(payload, self._sign(payload, self.secret_keys[0]))
+        if len(value)>self.max_size:
+            raise ValueError('Session cookie is %d bytes, exceeds the limit %d.' 
+                             %(len(value), self.max_size))
+        return value
+
+    def _load_session(self, value):
+        payload, signature=value.rsplit('.', 1)
+        if not any(hmac.compare_digest(signature, self._sign(payload, key)) 
+                   for key in self.secret_keys):
+            raise ValueError('Bad session cookie signature.')
+        
+        compressed=payload.startswith('.')
+        payload=payload.lstrip('.')
+        data=base64.urlsafe_b64decode(payload+'='*(-len(payload)%4))
+        if compressed:
+            data=zlib.decompress(data)
+        sid, issued, items=json.loads(data.decode('utf-8'))
+        if self.lifetime and issued+self.lifetime<time.time():
+            raise ValueError('Session cookie expired.')
+        
+        session=SessionDict(sid)
+        dict.update(session, items)
+        session.issued=issued
+        return session
+
+    def get_session(self, value):
+        session=BaseSession.get_session(self, value)
+        #只读的请求不会重新发cookie，签发超过一半有效期时重新签发。
+        issued=getattr(session, 'issued', None)
+        if self.lifetime and issued is not None and issued+self.lifetime/2<time.time():
+            session.mark_modified()
+        return session
+
+    def save_session(self, session):
+        #数据都在cookie里，cookie_value时才序列化。
+        pass
+
+    def cookie_value(self, session):
+        return self.dumps(session)
+
+
+class SQLiteSession(BaseSession):
+
+    '''存在SQLite数据库(WAL模式)里的session。
+    
+       SESSION_SHARDS大于1时按sid的hash分到多个数据库文件，
+       每保存SESSION_PURGE_INTERVAL次session，分批删除一次过期的session。
+       '''
+
+    def __init__(self, session_dir):
+        BaseSession.__init__(self, session_dir)
+        self.shards=config['SESSION_SHARDS']
+        self.lifetime=config['SESSION_LIFETIME']
+        self.purge_interval=config['SESSION_PURGE_INTERVAL']
+        self.purge_batch_size=config['SESSION_PURGE_BATCH_SIZE']
+        self._saves=0
+        #每个线程用自己的连接，shard -> sqlite3.Connection
+        self._local=threading.local()
+        os.makedirs(self.session_dir, exist_ok=True)
+
+    def _connect(self, shard):
+        connections=self._local.__dict__.setdefault('connections', {})
+        try:
+            return connections[shard]
+        except KeyError:
+            pass
+        
+        db_file=os.path.join(self.session_dir, 'sessions-%d.db' %shard)
+        conn=sqlite3.connect(db_file, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('CREATE TABLE IF NOT EXISTS sessions ('
+                     'sid TEXT PRIMARY KEY, data BLOB NOT NULL, expires REAL NOT NULL)')
+        conn.execute('CREATE INDEX IF NOT EXISTS sessions_expires ON sessions (expires)')
+        connections[shard]=conn
+        return conn
+
+    def _get_shard(self, sid):
+        return zlib.crc32(sid.encode('utf-8'))%self.shards
+
+    def _load_session(self, sid):
+        conn=self._connect(self._get_shard(sid))
+        now=time.time()
+        row=conn.execute('SELECT data, expires FROM sessions WHERE sid=? AND expires>?', 
+                         (sid, now)).fetchone()
+        if row is None:
+            raise KeyError(sid)
+        data, expires=row
+        #只读的请求不保存session，剩余时间不到一半时延长过期时间。
+        if expires-now<self.lifetime/2:
+            conn.execute('UPDATE sessions SET expires=? WHERE sid=?', 
+                         (now+self.lifetime, sid))
+        return pickle.loads(data)
+
+    def save_session(self, session):
+        conn=self._connect(self._get_shard(session.sid))
+        conn.execute('INSERT OR REPLACE INTO sessions (sid, data, expires) VALUES (?, ?, ?)',
+                     (session.sid, pickle.dumps(session), time.time()+self.lifetime))
+        session.modified=False
+        
+        self._saves+=1
+        if self.purge_interval and self._saves%self.purge_interval==0:
+            self.purge_expired()
+
+    def purge_expired(self, batch_size=None):
+        '''每个分片最多删除batch_size条过期的session，返回删除的条数。'''
+        batch_size=batch_size or self.purge_batch_size
+        now=time.time()
+        purged=0
+        for shard in range(self.shards):
+            cursor=self._connect(shard).execute(
+                'DELETE FROM sessions WHERE sid IN '
+                '(SELECT sid FROM sessions WHERE expires<=? LIMIT ?)', (now, batch_size))
+            purged+=cursor.rowcount
+        return purged
+
+
+class MemorySession(BaseSession):
+
+    '''存在进程内存里的session，适合单机部署。
+    
+       以SESSION_MEMORY_MAX_ENTRIES条和SESSION_MEMORY_MAX_BYTES字节为上限LRU淘汰，
+       超过SESSION_LIFETIME没有用到的session过期。
+       SESSION_WRITE_BEHIND为True时，修改过的session每隔SESSION_FLUSH_INTERVAL秒
+       在后台写入SESSION_DIR(FileSystemSession)，内存里没有时也会从那里加载，
+       重启后用户不会掉线。
+       '''
+
+    def __init__(self, session_dir):
+        BaseSession.__init__(self, session_dir)
+        self.lifetime=config['SESSION_LIFETIME']
+        #保存pickle后的bytes，每个请求拿到的都是自己的副本，也方便计算大小。
+        self.cache=LRUCache(config['SESSION_MEMORY_MAX_ENTRIES'], 
+                            ttl=self.lifetime,
+                            max_bytes=config['SESSION_MEMORY_MAX_BYTES'])
+        self.backend=None
+        if config['SESSION_WRITE_BEHIND']:
+            os.makedirs(self.session_dir, exist_ok=True)
+            self.backend=FileSystemSession(session_dir)
+            self.flush_interval=config['SESSION_FLUSH_INTERVAL']
+            #sid -> 还没写入backend的数据
+            self._dirty={}
+            self._dirty_lock=threading.Lock()
+            self._flush_thread=threading.Thread(target=self._flush_loop, daemon=True)
+            self._flush_thread.start()
+            atexit.register(self.flush)
+
+    def _load_session(self, sid):
+        now=time.time()
+        #缓存的是(data, 上次写入backend的时间)
+        entry=self.cache.get(sid)
+        if entry is not None:
+            data, saved=entry
+            #只读的请求不保存session，每次读取都延长内存里的过期时间，
+            #backend里的剩余时间不到一半时重新写入。
+            if self.backend is not None and now-saved>self.lifetime/2:
+                with self._dirty_lock:
+                    self._dirty.setdefault(sid, data)
+                self.cache.set(sid, (data, now), size=len(data))
+            else:
+                self.cache.touch(sid)
+        elif self.backend is not None:
+            with self._dirty_lock:
+                data=self._dirty.get(sid)
+            if data is None:
+                session=self.backend._load_session(sid)
+                data=pickle.dumps(session)
+            self.cache.set(sid, (data, now), size=len(data))
+        else:
+            raise KeyError(sid)
+        return pickle.loads(data)
+
+    def save_session(self, session):
+        data=pickle.dumps(session)
+        self.cache.set(session.sid, (data, time.time()), size=len(data))
+        if self.backend is not None:
+            with self._dirty_lock:
+                self._dirty[session.sid]=data
+        session.modified=False
+
+    def flush(self):
+        '''把修改过的session写入backend，返回写入的个数。'''
+        if self.backend is None:
+            return 0
+        with self._dirty_lock:
+            dirty, self._dirty=self._dirty, {}
+        for data in dirty.values():
+            self.backend.save_session(pickle.loads(data))
+        return len(dirty)
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                #写入失败时下一轮再试，不能让线程退出。
+                pass
 
 
 _SUPPORTED_SESSION={
     'filesystem': FileSystemSession,
-    'cookies': CookiesSession
+    'cookies': CookiesSession,
+    'sqlite': SQLiteSession,
+    'memory': MemorySession
 }
 
 
 def get_session_cls(session_store):
-    return _SUPPORTED_SESSION[session_store]
\ No newline at end of file
+    return _SUPPORTED_SESSION[session_store]
+
+
+#(session_store, session_dir) -> session manager，所有view共用。
+_session_managers={}
+_session_managers_lock=threading.Lock()
+
+
+def get_session_manager(session_store, session_dir):
+    key=(session_store, session_dir)
+    with _session_managers_lock:
+        if key not in _session_managers:
+            _session_managers[key]=get_session_cls(session_store)(session_dir)
+        return _session_managers[key]
+
+
+if __name__=='__main__':
+    #python -m webuilder.session SESSION_DIR，清理一遍过期的session文件。
+    import sys
+    
+    manager=FileSystemSession(sys.argv[1])
+    removed=manager.collect_garbage(max_files=float('inf'), 
+                                    max_dirs=FileSystemSession._shard_count)
+    print('Removed %d expired sessions.' %removed)
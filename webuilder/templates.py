@@ -1,6 +1,88 @@
 import os
+import threading
+import time
 
 import jinja2
+import jinja2.ext
+
+from .configuration import config
+from .datastructures import LRUCache
+
+
+class FragmentCacheExtension(jinja2.ext.Extension):
+
+    '''缓存模板片段的jinja2扩展。
+       
+       {% cache 'sidebar', 300 %}...{% endcache %}
+       
+       key和模板名一起作为缓存的key，ttl(秒)可以省略。缓存对象是
+       environment.fragment_cache，只要有get(key)和set(key, value, ttl)就可以，
+       默认是进程内的LRUCache。
+       '''
+
+    tags={'cache'}
+
+    def __init__(self, environment):
+        jinja2.ext.Extension.__init__(self, environment)
+        environment.extend(fragment_cache=None)
+
+    def parse(self, parser):
+        lineno=next(parser.stream).lineno
+        args=[jinja2.nodes.Const(parser.name), parser.parse_expression()]
+        if parser.stream.skip_if('comma'):
+            args.append(parser.parse_expression())
+        else:
+            args.append(jinja2.nodes.Const(None))
+        body=parser.parse_statements(['name:endcache'], drop_needle=True)
+        return jinja2.nodes.CallBlock(
+            self.call_method('_cache', args), [], [], body).set_lineno(lineno)
+
+    def _cache(self, template_name, key, ttl, caller):
+        fragment_cache=self.environment.fragment_cache
+        cache_key='fragment:%s:%s' %(template_name, key)
+        fragment=fragment_cache.get(cache_key)
+        if fragment is None:
+            fragment=caller()
+            fragment_cache.set(cache_key, fragment, ttl)
+        return fragment
+
+
+def make_fragment_cache():
+    #没有设置TEMPLATE_FRAGMENT_CACHE时，用进程内的LRUCache。
+    fragment_cache=config.get('TEMPLATE_FRAGMENT_CACHE')
+    if fragment_cache is None:
+        fragment_cache=LRUCache(config['TEMPLATE_FRAGMENT_CACHE_SIZE'],
+                                config['TEMPLATE_FRAGMENT_CACHE_TTL'])
+    return fragment_cache
+
+
+#template_dir -> jinja2.Environment，整个进程共用。
+_jinja2_environments={}
+_environments_lock=threading.Lock()
+
+
+def get_jinja2_environment(template_dir):
+    try:
+        return _jinja2_environments[template_dir]
+    except KeyError:
+        pass
+    
+    with _environments_lock:
+        if template_dir not in _jinja2_environments:
+            options={
+                'loader': jinja2.FileSystemLoader(template_dir),
+                'extensions': [FragmentCacheExtension],
+                #为False时不再检查模板文件的修改时间。
+                'auto_reload': config['TEMPLATE_AUTO_RELOAD']
+            }
+            bytecode_cache_dir=config.get('TEMPLATE_BYTECODE_CACHE_DIR')
+            if bytecode_cache_dir:
+                os.makedirs(bytecode_cache_dir, exist_ok=True)
+                options['bytecode_cache']=jinja2.FileSystemBytecodeCache(bytecode_cache_dir)
+            environment=jinja2.Environment(**options)
+            environment.fragment_cache=make_fragment_cache()
+            _jinja2_environments[template_dir]=environment
+        return _jinja2_environments[template_dir]
 
 
 class BaseTemplate:
@@ -14,35 +96,123 @@ class BaseTemplate:
     
     def __call__(self):
         raise NotImplementedError
+    
+    def generate(self):
+        '''返回逐块生成渲染结果(str)的迭代器。'''
+        raise NotImplementedError
+    
+    @classmethod
+    def precompile(cls, template_dir, template_file):
+        '''编译模板并放进缓存，有语法错误时抛出异常。'''
+        raise NotImplementedError
+    
+    @classmethod
+    def list_templates(cls, template_dir, extensions):
+        '''列出template_dir下扩展名在extensions里的模板，跳过隐藏的目录和文件。'''
+        template_files=[]
+        for root, dirs, files in os.walk(template_dir):
+            dirs[:]=sorted(_dir for _dir in dirs if not _dir.startswith('.'))
+            for file_name in sorted(files):
+                if file_name.startswith('.'):
+                    continue
+                if os.path.splitext(file_name)[1].lower() not in extensions:
+                    continue
+                template_files.append(os.path.relpath(
+                    os.path.join(root, file_name), template_dir).replace(os.sep, '/'))
+        return template_files
 
 
 class Jinja2Template(BaseTemplate):
     
     def __call__(self):
-        environment=jinja2.Environment(loader=jinja2.FileSystemLoader(self.template_dir))
+        environment=get_jinja2_environment(self.template_dir)
         return environment.get_template(self.template_file).render(**self.template_args)
+    
+    def generate(self):
+        environment=get_jinja2_environment(self.template_dir)
+        return environment.get_template(self.template_file).generate(**self.template_args)
+    
+    @classmethod
+    def precompile(cls, template_dir, template_file):
+        get_jinja2_environment(template_dir).get_template(template_file)
+    
+    @classmethod
+    def list_templates(cls, template_dir, extensions):
+        environment=get_jinja2_environment(template_dir)
+        return environment.list_templates(
+            extensions=[extension.lstrip('.') for extension in extensions])
 
 
 try:
-    import mako.template as mako
+    import mako.lookup
+    
+    #template_dir -> mako.lookup.TemplateLookup，整个进程共用。
+    _mako_lookups={}
+    
+    def get_mako_lookup(template_dir):
+        try:
+            return _mako_lookups[template_dir]
+        except KeyError:
+            pass
+        
+        with _environments_lock:
+            if template_dir not in _mako_lookups:
+                #设置了TEMPLATE_MODULE_DIR时，编译好的模板module会保存到这个目录。
+                module_dir=config.get('TEMPLATE_MODULE_DIR')
+                if module_dir:
+                    os.makedirs(module_dir, exist_ok=True)
+                _mako_lookups[template_dir]=mako.lookup.TemplateLookup(
+                    directories=[template_dir],
+                    module_directory=module_dir or None,
+                    filesystem_checks=config['TEMPLATE_AUTO_RELOAD'])
+            return _mako_lookups[template_dir]
     
     class MakoTemplate(BaseTemplate):
         
         def __call__(self):
-            template_path=os.path.join(self.template_dir, self.template_file)
-            template=mako.Template(filename=template_path)
-            return template.render(**self.template_args)
+            lookup=get_mako_lookup(self.template_dir)
+            return lookup.get_template(self.template_file).render(**self.template_args)
+        
+        def generate(self):
+            #mako渲染时写入buffer，没有逐块生成的接口，只能整个渲染完再输出。
+            return iter([self()])
+        
+        @classmethod
+        def precompile(cls, template_dir, template_file):
+            get_mako_lookup(template_dir).get_template(template_file)
 
 except ImportError:
-    pass
+    MakoTemplate=None
 
 
-#如果没有mako会出错吧...啊...懒得改了
 _SUPPORTED_TEMPLATE_ENGINE={
-    'jinja2': Jinja2Template,
-    'mako': MakoTemplate
+    'jinja2': Jinja2Template
 }
 
 
+if MakoTemplate:
+    _SUPPORTED_TEMPLATE_ENGINE['mako']=MakoTemplate
+
+
 def get_template_cls(template_name):
-    return _SUPPORTED_TEMPLATE_ENGINE[template_name]
\ No newline at end of file
+    return _SUPPORTED_TEMPLATE_ENGINE[template_name]
+
+
+def precompile_templates(template_dir, template_engine=None, extensions=None):
+    '''编译template_dir下的所有模板，返回{模板名: 编译用时(秒)}。
+       
+       只编译扩展名在extensions(默认PRECOMPILE_TEMPLATE_EXTENSIONS)里的文件，
+       有语法错误的模板会直接抛出异常。
+       '''
+    template_cls=get_template_cls(template_engine or config['TEMPLATE_ENGINE'])
+    template_dir=os.path.abspath(template_dir)
+    if extensions is None:
+        extensions=config['PRECOMPILE_TEMPLATE_EXTENSIONS']
+    extensions=[extension.lower() for extension in extensions]
+    
+    compile_times={}
+    for template_file in template_cls.list_templates(template_dir, extensions):
+        start=time.perf_counter()
+        template_cls.precompile(template_dir, template_file)
+        compile_times[template_file]=time.perf_counter()-start
+    return compile_times
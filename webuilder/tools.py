@@ -1,53 +1,82 @@
-import sqlite3
+import time
+import asyncio
+import inspect
 
 from functools import wraps
 
 from .configuration import config
-from .session import get_session_cls
+from .session import get_session_cls, get_session_manager, LazySession
 from .exceptions import HTTPError
+from .datastructures import LRUCache
+from .database import LazyConnection, get_pool
+from .helpers import make_list
+from .response import Response
 
 
 def session(func):
-    try:
-        session_store=config['SESSION_STORE']
-        session_cls=get_session_cls(session_store)
-    except KeyError as e:
-        raise ValueError('Unsupported session type %s.' %session_store) from e
-    
     try:
         session_dir=config['SESSION_DIR']
     except KeyError:
         config['SESSION_DIR']='sessions'
         session_dir=config['SESSION_DIR']        
 
-    session_manager=session_cls(session_dir)
+    session_store=config['SESSION_STORE']
+    try:
+        get_session_cls(session_store)
+    except KeyError as e:
+        raise ValueError('Unsupported session type %s.' %session_store) from e
+    session_manager=get_session_manager(session_store, session_dir)
     
-    @wraps
-    def wrapper(request, **kwargs):
+    def save(session, sid, response):
+        #新session没有写入过就不发SESSIONID cookie。
+        if session.modified:
+            session_manager.save_session(session.session)
+            cookie_value=session_manager.cookie_value(session.session)
+            if cookie_value!=sid:
+                response.set_cookie('SESSIONID', cookie_value)
+    
+    def load(request, kwargs):
         try:
             sid=request.cookie['SESSIONID']
         except KeyError:
             sid=None
-         
-        if sid:  
-            session=session_manager.get_session(sid)
-        else:
-            session=session_manager.create_new_session()
+        
+        #view function用到session时才加载。
+        session=LazySession(session_manager, sid)
         kwargs['session']=session
+        return session, sid
+    
+    if inspect.iscoroutinefunction(func):
+        @wraps(func)
+        async def async_wrapper(request, **kwargs):
+            session, sid=load(request, kwargs)
+            #读写session文件或数据库放到线程池里，不阻塞event loop。
+            loop=asyncio.get_running_loop()
+            if sid:
+                await loop.run_in_executor(None, getattr, session, 'session')
+            try:
+                response=await func(request=request, **kwargs)
+            except HTTPError as e:
+                await loop.run_in_executor(None, save, session, sid, e)
+                raise
+            await loop.run_in_executor(None, save, session, sid, response)
+            return response
+        
+        return async_wrapper
+    
+    @wraps(func)
+    def wrapper(request, **kwargs):
+        session, sid=load(request, kwargs)
         
         try:
             response=func(request=request, **kwargs)
         except HTTPError as e:
-            session_manager.save_session(session)
-            if not sid:
-                e.set_cookie('SESSIONID', session.sid) 
+            save(session, sid, e)
             raise
         except Exception:
             raise
         else:
-            session_manager.save_session(session)
-            if not sid:
-                response.set_cookie('SESSIONID', session.sid)
+            save(session, sid, response)
             return response
                 
     return wrapper
@@ -58,10 +87,25 @@ def sqlite_db(func):
         db_file=config['DATABASE_FILE'].rstrip('/')
     except KeyError as e:
         raise KeyError('No database file found.') from e
+    
+    if inspect.iscoroutinefunction(func):
+        @wraps(func)
+        async def async_wrapper(request, **kwargs):
+            db=LazyConnection(get_pool(db_file))
+            kwargs['db']=db
+            #连接池没有空闲连接时会等待，先在线程池里取好连接，不阻塞event loop。
+            await db.acquire()
+            try:
+                return await func(request=request, **kwargs)
+            finally:
+                await asyncio.get_running_loop().run_in_executor(None, db.release)
+        
+        return async_wrapper
         
-    @wraps
+    @wraps(func)
     def wrapper(request, **kwargs):
-        db=sqlite3.connect(db_file) 
+        #view function用到db时才从连接池取连接。
+        db=LazyConnection(get_pool(db_file))
         kwargs['db']=db
         try:
             response=func(request=request, **kwargs)
@@ -69,7 +113,109 @@ def sqlite_db(func):
         except Exception:
             raise
         finally:
-            db.close()
+            db.release()
             
     return wrapper
-    
\ No newline at end of file
+
+
+#cached_response共用的缓存，第一次用到时生成。
+_response_cache=None
+
+
+def _get_response_cache():
+    global _response_cache
+    if _response_cache is None:
+        _response_cache=LRUCache(config['RESPONSE_CACHE_SIZE'])
+    return _response_cache
+
+
+def _make_response_cache_key(request, vary):
+    #key以method:path?query_string开头，方便按前缀清除。
+    key='%s:%s?%s' %(request.method, request.path, request.raw_query_string)
+    for name in vary:
+        if name.lower().startswith('cookie:'):
+            value=request.cookie.get(name.split(':', 1)[-1], '')
+        else:
+            value=request.header.get(name, '')
+        key+='|%s=%s' %(name, value)
+    return key
+
+
+def invalidate_cached_responses(prefix=''):
+    '''清除key以prefix开头的缓存，key的格式是METHOD:/path?query_string|...'''
+    response_cache=_get_response_cache()
+    for key in response_cache.keys():
+        if key.startswith(prefix):
+            response_cache.delete(key)
+
+
+def cached_response(ttl=60, vary=None):
+    '''缓存整个响应，命中时不调用view function。
+    
+       只缓存GET/HEAD请求的200响应，设置了cookie或者流式body的响应不缓存。
+       vary是要加进key的请求header名，cookie用'cookie:名字'。
+       '''
+    vary=make_list(vary) if vary else []
+    #按header区分的缓存要告诉下游缓存Vary，按cookie区分的只能由浏览器缓存。
+    vary_headers=[name for name in vary if not name.lower().startswith('cookie:')]
+    cache_control='max-age=%d' %ttl
+    if len(vary_headers)<len(vary):
+        cache_control='private, '+cache_control
+        vary_headers.append('Cookie')
+    
+    def lookup(request):
+        response_cache=_get_response_cache()
+        key=_make_response_cache_key(request, vary)
+        cached=response_cache.get(key)
+        if cached is None:
+            return key, None
+        
+        status, headerlist, body, created=cached
+        age=int(time.time()-created)
+        response=Response(body=body)
+        response.status=status
+        for name, value in headerlist:
+            response.header[name]=value
+        #下游缓存会自己用max-age减去Age
+        response.header['Age']=age
+        return key, response
+    
+    def store(key, response):
+        if response.code==200 and not response.cookies and not response.is_streaming:
+            response.header['Cache-Control']=cache_control
+            if vary_headers:
+                response.header['Vary']=', '.join(vary_headers)
+            body=b''.join(response.get_body())
+            headerlist=[(name, value) for name, value in response.headerlist
+                        if name!='Content-Length']
+            _get_response_cache().set(
+                key, (response.status, headerlist, body, time.time()), ttl)
+        return response
+    
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @wraps(func)
+            async def async_wrapper(request, **kwargs):
+                if request.method not in ('GET', 'HEAD'):
+                    return await func(request=request, **kwargs)
+                
+                key, response=lookup(request)
+                if response is not None:
+                    return response
+                return store(key, await func(request=request, **kwargs))
+            
+            return async_wrapper
+        
+        @wraps(func)
+        def wrapper(request, **kwargs):
+            if request.method not in ('GET', 'HEAD'):
+                return func(request=request, **kwargs)
+            
+            key, response=lookup(request)
+            if response is not None:
+                return response
+            return store(key, func(request=request, **kwargs))
+        
+        return wrapper
+    
+    return decorator